@@ -0,0 +1,91 @@
+import atexit
+import os
+import shlex
+import socket
+import subprocess
+import time
+import urllib.request
+from urllib.parse import urlparse
+
+# --------- Persistent Mermaid render server ----------
+# NEW: Keeps one warm browser alive instead of booting Chromium for every diagram.
+# Configure via env:
+#   MERMAID_SERVER_URL  - render endpoint of an already running server (POST body = Mermaid code, reply = SVG)
+#   MERMAID_SERVER_CMD  - command that starts one locally, "{port}" is filled in (e.g. "node render_server.js --port {port}")
+#   MERMAID_SERVER_PORT - port used with MERMAID_SERVER_CMD (default 7878)
+DEFAULT_PORT = int(os.getenv("MERMAID_SERVER_PORT", "7878"))
+STARTUP_TIMEOUT = 15  # seconds to wait for a spawned server to accept connections
+
+
+class RenderClient:
+    """Thin HTTP client for a local Mermaid render server."""
+
+    def __init__(self, url: str, process=None):
+        self.url = url
+        self.process = process
+
+    def is_alive(self) -> bool:
+        if self.process is not None and self.process.poll() is not None:
+            return False
+        parsed = urlparse(self.url)
+        return _port_open(parsed.hostname, parsed.port or 80)
+
+    def render_svg(self, mermaid_code: str, timeout: float = 30) -> bytes:
+        request = urllib.request.Request(
+            self.url,
+            data=mermaid_code.encode("utf-8"),
+            headers={"Content-Type": "text/plain; charset=utf-8"},
+            method="POST",
+        )
+        with urllib.request.urlopen(request, timeout=timeout) as resp:
+            return resp.read()
+
+    def close(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+
+
+def _port_open(host: str, port: int) -> bool:
+    try:
+        with socket.create_connection((host, port), timeout=0.5):
+            return True
+    except OSError:
+        return False
+
+
+def start_render_client():
+    """Connect to (or spawn) the render server. Returns None if none is configured or reachable."""
+    url = os.getenv("MERMAID_SERVER_URL")
+    cmd = os.getenv("MERMAID_SERVER_CMD")
+
+    if url:
+        client = RenderClient(url)
+        if client.is_alive():
+            return client
+        print(f"[warn] Mermaid render server not reachable at {url}. Using local renderer.")
+        return None
+
+    if not cmd:
+        return None
+
+    try:
+        process = subprocess.Popen(shlex.split(cmd.format(port=DEFAULT_PORT)),
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except OSError as e:
+        print(f"[warn] Could not start Mermaid render server: {e}")
+        return None
+
+    client = RenderClient(f"http://127.0.0.1:{DEFAULT_PORT}/render", process)
+    atexit.register(client.close)
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        if client.is_alive():
+            print(f"[info] Mermaid render server running at {client.url}")
+            return client
+        if process.poll() is not None:
+            break
+        time.sleep(0.2)
+
+    print("[warn] Mermaid render server did not start. Using local renderer.")
+    client.close()
+    return None
@@ -1,6 +1,10 @@
 import streamlit as st
 import os
 import sys
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from dotenv import load_dotenv
 
 # NEW: Import your agent code (adjust path if needed)
@@ -18,6 +22,138 @@ if not api_key:
     st.error("❌ OpenAI API key missing in app secrets!")
     st.stop()
 
+# NEW: One warm Mermaid render server per app process (None if not configured)
+@st.cache_resource(show_spinner=False)
+def get_render_client():
+    return ag.start_render_client()
+
+# NEW: SVG -> PDF runs in worker processes (Cairo is not thread-friendly), off the request path.
+# "spawn", not fork: forking Streamlit's multi-threaded server can copy held locks into the workers.
+@st.cache_resource(show_spinner=False)
+def get_pdf_pool():
+    return ProcessPoolExecutor(max_workers=3, mp_context=multiprocessing.get_context("spawn"))
+
+def start_pdf_conversion(pdf_pool, pdf_futures: dict, diagram_type: str, svg_path: str):
+    """Queue PDF export for a freshly rendered SVG; the download fragment awaits its bytes.
+
+    pdf_pool is fetched on the script thread: this may run on a render worker thread,
+    where calling the st.cache_resource getter has no ScriptRunContext.
+    """
+    if ag.CAIROSVG_AVAILABLE and os.path.exists(svg_path):
+        pdf_path = os.path.splitext(svg_path)[0] + ".pdf"
+        try:
+            pdf_futures[diagram_type.lower()] = pdf_pool.submit(ag.svg_to_pdf, svg_path, pdf_path)
+        except (BrokenProcessPool, RuntimeError) as e:
+            # A worker died (or the pool shut down): skip this PDF, rebuild the pool on the next run
+            print(f"[warn] PDF export skipped for {diagram_type}: {e}")
+            get_pdf_pool.clear()
+
+def record_render(svg_files: set, pdf_pool, pdf_futures: dict, diagram_type: str, svg_path: str):
+    """Called for each SVG written in this run: remember it for the previews and start its PDF."""
+    svg_files.add(os.path.basename(svg_path))
+    start_pdf_conversion(pdf_pool, pdf_futures, diagram_type, svg_path)
+
+def record_render_future(svg_files: set, pdf_pool, pdf_futures: dict, diagram_type: str, render_future):
+    """Done-callback for a render_mermaid_file future; failed renders (None) are ignored."""
+    svg_path = render_future.result()
+    if svg_path is not None:
+        record_render(svg_files, pdf_pool, pdf_futures, diagram_type, svg_path)
+
+# NEW: Parse and generation are cached separately. The parse is keyed on a hash of the
+# whitespace-normalized BRD (spacing/line-break edits reuse it; case changes do not, since
+# entity names keep their casing); the leading underscore keeps Streamlit from hashing the
+# full text. Generation is keyed on the extracted JSON.
+def brd_cache_key(brd_text: str) -> str:
+    return hashlib.sha256(" ".join(brd_text.split()).encode("utf-8")).hexdigest()
+
+@st.cache_data(max_entries=64, ttl=3600, show_spinner=False)
+def cached_parse(brd_hash: str, _brd_text: str) -> str:
+    return ag.parse_brd_tool(_brd_text)
+
+@st.cache_data(max_entries=64, ttl=3600, show_spinner=False)
+def cached_generate(extracted: str) -> tuple:
+    return ag.generate_all_diagrams_tool(extracted)
+
+# NEW: Downloads + previews rerun on their own, so clicking a download does not re-run the pipeline
+@st.fragment
+def _downloads_and_previews(dfd, logic, db):
+    # Download Buttons (For Codes/Images)
+    st.markdown("---")
+    st.subheader("💾 Downloads")
+    col_d1, col_d2, col_d3 = st.columns(3)
+    pdf_slots = {}
+    
+    with col_d1:
+        st.download_button(
+            "📥 Download DFD Code",
+            dfd or "No DFD generated",
+            file_name="dfd.mmd",
+            mime="text/plain"
+        )
+        # NEW: PDF Download (filled in below once the background conversion finishes)
+        pdf_slots["dfd"] = ("DFD", st.empty())
+    
+    with col_d2:
+        st.download_button(
+            "📥 Download Logic Code",
+            logic or "No Logic generated",
+            file_name="logic.mmd",
+            mime="text/plain"
+        )
+        # NEW: PDF Download (filled in below once the background conversion finishes)
+        pdf_slots["logic"] = ("Logic", st.empty())
+    
+    with col_d3:
+        st.download_button(
+            "📥 Download ERD Code",
+            db or "No ERD generated",
+            file_name="erd.mmd",
+            mime="text/plain"
+        )
+        # NEW: PDF Download (filled in below once the background conversion finishes)
+        pdf_slots["erd"] = ("ERD", st.empty())
+    
+    # Image Previews (If Rendered)
+    # NEW: SVG names come from session_state (recorded as this generation rendered them), no stat calls
+    svg_files = st.session_state.get("svg_files", set())
+    if ag.MERMAID_AVAILABLE or get_render_client() is not None:
+        st.markdown("## 🖼️ Rendered Images")
+        col_i1, col_i2, col_i3 = st.columns(3)
+        
+        with col_i1:
+            if "dfd.svg" in svg_files:
+                st.image("output/dfd.svg", caption="DFD", use_column_width=True)
+        
+        with col_i2:
+            if "logic.svg" in svg_files:
+                st.image("output/logic.svg", caption="Logic", use_column_width=True)
+        
+        with col_i3:
+            if "erd.svg" in svg_files:
+                st.image("output/erd.svg", caption="ERD", use_column_width=True)
+
+    # NEW: Await PDFs last, so code downloads and previews show up first.
+    # Bytes are kept in session_state, so later reruns never touch the disk.
+    pdf_futures = st.session_state.get("pdf_futures", {})
+    for name, (label, slot) in pdf_slots.items():
+        key = f"{name}_pdf_bytes"
+        if key not in st.session_state:
+            future = pdf_futures.get(name)
+            if future is None:
+                continue
+            try:
+                with slot, st.spinner(f"Converting {name}.pdf..."):
+                    st.session_state[key] = future.result()
+            except Exception as e:
+                slot.error(f"PDF conversion failed: {e}")
+                continue
+        slot.download_button(
+            f"📥 Download {label} PDF",
+            st.session_state[key],
+            file_name=f"{name}.pdf",
+            mime="application/pdf"
+        )
+
 # Streamlit Page Config (Title, layout)
 st.set_page_config(page_title="BRD Diagram Agent", page_icon="📊", layout="wide")
 
@@ -31,6 +167,12 @@ st.sidebar.markdown("""
 
 **Powered by:** LangChain + OpenAI + Mermaid
 """)
+# NEW: Live token streaming (one call per diagram) vs. the cached single batched call
+stream_output = st.sidebar.toggle(
+    "⚡ Stream diagrams live",
+    value=False,
+    help="Show Mermaid code as it is generated. Uses one LLM call per diagram instead of one batched call."
+)
 
 # Main Title
 st.title("📈 Generate DFD, Logic, and DB Diagrams from Your BRD")
@@ -61,33 +203,36 @@ with col2:
 # Process Input
 if generate_btn or uploaded_file or brd_text.strip():
     if uploaded_file:
-        # UPDATED: Enhanced file reading (PDF/TXT/MD/DOCX)
-        if uploaded_file.type == "application/pdf":
-            try:
-                import pypdf2
-                reader = pypdf2.PdfReader(uploaded_file)
-                brd_text = ""
-                for page in reader.pages:
-                    brd_text += page.extract_text() + "\n"
-                if not brd_text.strip():
-                    st.warning("PDF read empty—might be scanned image. Try OCR tools or paste text.")
-                else:
-                    st.success(f"📄 Loaded PDF: {len(brd_text)} chars")
-            except Exception as e:
-                st.error(f"PDF read failed: {e}. Paste text instead?")
-                brd_text = ""
-        elif uploaded_file.name.endswith('.docx'):
-            try:
-                from docx import Document
-                doc = Document(uploaded_file)
-                brd_text = "\n".join([para.text for para in doc.paragraphs])
-                st.success(f"📄 Loaded DOCX: {len(doc.paragraphs)} paragraphs")
-            except Exception as e:
-                st.error(f"DOCX read failed: {e}. Install python-docx?")
-                brd_text = ""
-        else:  # TXT/MD
-            brd_text = uploaded_file.read().decode("utf-8")
-            st.success(f"📄 Loaded {uploaded_file.name}")
+        # NEW: Parse each upload once; reruns with the same file reuse the extracted text
+        upload_hash = hashlib.blake2b(uploaded_file.getvalue(), digest_size=16).hexdigest()
+        if st.session_state.get("upload_hash") == upload_hash:
+            brd_text = st.session_state["upload_text"]
+        else:
+            # UPDATED: Enhanced file reading (PDF/TXT/MD/DOCX)
+            if uploaded_file.type == "application/pdf":
+                try:
+                    brd_text = ag.extract_pdf_text(uploaded_file.read())  # NEW: PyMuPDF (fast C extraction)
+                    if not brd_text.strip():
+                        st.warning("PDF read empty—might be scanned image. Try OCR tools or paste text.")
+                    else:
+                        st.success(f"📄 Loaded PDF: {len(brd_text)} chars")
+                except Exception as e:
+                    st.error(f"PDF read failed: {e}. Paste text instead?")
+                    brd_text = ""
+            elif uploaded_file.name.endswith('.docx'):
+                try:
+                    from docx import Document
+                    doc = Document(uploaded_file)
+                    brd_text = "\n".join([para.text for para in doc.paragraphs])
+                    st.success(f"📄 Loaded DOCX: {len(doc.paragraphs)} paragraphs")
+                except Exception as e:
+                    st.error(f"DOCX read failed: {e}. Install python-docx?")
+                    brd_text = ""
+            else:  # TXT/MD
+                brd_text = uploaded_file.read().decode("utf-8")
+                st.success(f"📄 Loaded {uploaded_file.name}")
+            st.session_state["upload_hash"] = upload_hash
+            st.session_state["upload_text"] = brd_text
     elif not brd_text.strip():
         st.warning("Add text or upload a file!")
         st.stop()
@@ -96,62 +241,76 @@ if generate_btn or uploaded_file or brd_text.strip():
     with st.expander("👁️ Preview BRD Text"):
         st.text_area("Preview:", brd_text, height=150, disabled=True)
 
-    # Progress Bar (Fun!)
-    progress_bar = st.progress(0)
-    status = st.empty()
+    # NEW: Only re-run the pipeline when the BRD text changed (widget clicks just re-show results)
+    brd_hash = brd_cache_key(brd_text)
+    if st.session_state.get("brd_hash") != brd_hash:
+        # Progress Bar (Fun!)
+        progress_bar = st.progress(0)
+        status = st.empty()
 
-    # Run Your Agent/Fallback
-    status.text("🤖 Parsing BRD...")
-    progress_bar.progress(0.3)
+        # Run Your Agent/Fallback
+        status.text("🤖 Parsing BRD...")
+        progress_bar.progress(0.3)
     
-    if ag.agent is not None:
-        # Agent Mode
-        result = ag.agent.invoke({"input": brd_text})
-        output = result if isinstance(result, str) else result.get("output", str(result))
-        status.text("✅ Agent complete!")
-    else:
-        # Fallback Pipeline
-        status.text("🔄 Running pipeline...")
-        progress_bar.progress(0.6)
-        extracted = ag.parse_brd_tool(brd_text)
-        dfd = ag.generate_dfd_tool(extracted)
-        logic = ag.generate_logic_tool(extracted)
-        db = ag.generate_db_tool(extracted)
-        progress_bar.progress(1.0)
-        
-        # Render & Save (Reuse your function)
-        output_dir = "output"
-        os.makedirs(output_dir, exist_ok=True)
-        
-        dfd_rendered = ag.render_and_save_mermaid(dfd, "DFD", output_dir)
-        logic_rendered = ag.render_and_save_mermaid(logic, "Logic", output_dir)
-        db_rendered = ag.render_and_save_mermaid(db, "ERD", output_dir)
+        agent = ag.agent_for(brd_text)  # NEW: None for short BRDs -> deterministic pipeline
+        if agent is not None:
+            # Agent Mode
+            result = agent.invoke({"input": brd_text})
+            output = result if isinstance(result, str) else result.get("output", str(result))
+            status.text("✅ Agent complete!")
+        else:
+            # Fallback Pipeline
+            status.text("🔄 Running pipeline...")
+            progress_bar.progress(0.6)
+
+            # Render & Save (Reuse your function)
+            output_dir = "output"
+            os.makedirs(output_dir, exist_ok=True)
+            pdf_futures = {}  # NEW: {name: Future[pdf_path]}, started as each SVG lands
+            svg_files = set()  # NEW: SVGs actually written by this run (stale files in output/ are ignored)
+            pdf_pool = get_pdf_pool()  # Fetched here on the script thread; callbacks may run on worker threads
+
+            if stream_output:
+                # NEW: Stream each diagram into the page; render it in the background while the next one streams
+                extracted = cached_parse(brd_hash, brd_text)
+                codes = {}
+                with ThreadPoolExecutor(max_workers=3) as render_pool:
+                    for diagram_type, stream_tool in [("DFD", ag.stream_dfd_tool),
+                                                      ("Logic", ag.stream_logic_tool),
+                                                      ("ERD", ag.stream_db_tool)]:
+                        st.markdown(f"**{diagram_type}**")
+                        placeholder = st.empty()
+                        codes[diagram_type] = ag.strip_mermaid_fences(placeholder.write_stream(stream_tool(extracted)))
+                        placeholder.code(codes[diagram_type], language="text")
+                        render_pool.submit(ag.render_mermaid_file, codes[diagram_type], diagram_type,
+                                           output_dir, get_render_client()).add_done_callback(
+                            lambda f, t=diagram_type: record_render_future(svg_files, pdf_pool, pdf_futures, t, f))
+                dfd, logic, db = codes["DFD"], codes["Logic"], codes["ERD"]
+                progress_bar.progress(1.0)
+            else:
+                extracted = cached_parse(brd_hash, brd_text)
+                dfd, logic, db = cached_generate(extracted)
+                progress_bar.progress(1.0)
+
+                # NEW: Render all three diagrams concurrently (mmdc if installed, else mermaid-py)
+                ag.render_batch_mermaid({"DFD": dfd, "Logic": logic, "ERD": db}, output_dir, get_render_client(),
+                                        on_rendered=lambda t, p: record_render(svg_files, pdf_pool, pdf_futures, t, p))
         
-        # NEW: Auto-save .mmd codes to output/
-        with open(os.path.join(output_dir, "dfd.mmd"), "w", encoding="utf-8") as f:
-            f.write(dfd)
-        with open(os.path.join(output_dir, "logic.mmd"), "w", encoding="utf-8") as f:
-            f.write(logic)
-        with open(os.path.join(output_dir, "erd.mmd"), "w", encoding="utf-8") as f:
-            f.write(db)
+            # NEW: Auto-save .mmd codes to output/
+            with open(os.path.join(output_dir, "dfd.mmd"), "w", encoding="utf-8") as f:
+                f.write(dfd)
+            with open(os.path.join(output_dir, "logic.mmd"), "w", encoding="utf-8") as f:
+                f.write(logic)
+            with open(os.path.join(output_dir, "erd.mmd"), "w", encoding="utf-8") as f:
+                f.write(db)
         
-        # NEW: Convert SVG to PDF (requires pip install cairosvg)
-        try:
-            from cairosvg import svg2pdf
-            for svg_name, pdf_name in [("dfd.svg", "dfd.pdf"), ("logic.svg", "logic.pdf"), ("erd.svg", "erd.pdf")]:
-                svg_path = os.path.join(output_dir, svg_name)
-                if os.path.exists(svg_path):
-                    pdf_path = os.path.join(output_dir, pdf_name)
-                    svg2pdf(url=svg_path, write_to=pdf_path)
-                    st.success(f"📄 PDF saved: {pdf_path}")
-        except ImportError:
-            st.warning("For PDF export, install cairosvg: pip install cairosvg")
-        except Exception as e:
-            st.error(f"PDF conversion failed: {e}")
+            # NEW: SVG -> PDF conversion already started in the background (requires pip install cairosvg)
+            if not ag.CAIROSVG_AVAILABLE:
+                st.warning("For PDF export, install cairosvg: pip install cairosvg")
         
-        st.info(f"💾 Saved .mmd codes + SVGs/PDFs to {output_dir}/")
+            st.info(f"💾 Saved .mmd codes + SVGs/PDFs to {output_dir}/")
         
-        output = f"""
+            output = f"""
 ### Extracted JSON:
 ```{extracted}```
 
@@ -163,88 +322,31 @@ if generate_btn or uploaded_file or brd_text.strip():
 
 ### DB ERD:
 ```{db}```
-        """
-        status.text("✅ Pipeline complete!")
+            """
+            status.text("✅ Pipeline complete!")
+
+        progress_bar.progress(1.0)
+        st.session_state["results"] = {
+            "output": output,
+            "extracted": extracted if 'extracted' in locals() else None,
+            "dfd": dfd if 'dfd' in locals() else None,
+            "logic": logic if 'logic' in locals() else None,
+            "db": db if 'db' in locals() else None,
+        }
+        st.session_state["pdf_futures"] = pdf_futures if 'pdf_futures' in locals() else {}
+        st.session_state["svg_files"] = svg_files if 'svg_files' in locals() else set()
+        for name in ("dfd", "logic", "erd"):
+            st.session_state.pop(f"{name}_pdf_bytes", None)  # Drop PDFs of the previous BRD
+        st.session_state["brd_hash"] = brd_hash
+        st.balloons()  # Party confetti! 🎉
 
-    progress_bar.progress(1.0)
-    st.balloons()  # Party confetti! 🎉
+    results = st.session_state["results"]
 
     # Display Results
     st.markdown("## 📊 Generated Diagrams")
-    st.markdown(output)
+    st.markdown(results["output"])
 
-    # Download Buttons (For Codes/Images)
-    st.markdown("---")
-    st.subheader("💾 Downloads")
-    col_d1, col_d2, col_d3 = st.columns(3)
-    
-    with col_d1:
-        st.download_button(
-            "📥 Download DFD Code",
-            dfd if 'dfd' in locals() else "No DFD generated",
-            file_name="dfd.mmd",
-            mime="text/plain"
-        )
-        # NEW: PDF Download
-        if os.path.exists("output/dfd.pdf"):
-            with open("output/dfd.pdf", "rb") as f:
-                st.download_button(
-                    "📥 Download DFD PDF",
-                    f.read(),
-                    file_name="dfd.pdf",
-                    mime="application/pdf"
-                )
-    
-    with col_d2:
-        st.download_button(
-            "📥 Download Logic Code",
-            logic if 'logic' in locals() else "No Logic generated",
-            file_name="logic.mmd",
-            mime="text/plain"
-        )
-        # NEW: PDF Download
-        if os.path.exists("output/logic.pdf"):
-            with open("output/logic.pdf", "rb") as f:
-                st.download_button(
-                    "📥 Download Logic PDF",
-                    f.read(),
-                    file_name="logic.pdf",
-                    mime="application/pdf"
-                )
-    
-    with col_d3:
-        st.download_button(
-            "📥 Download ERD Code",
-            db if 'db' in locals() else "No ERD generated",
-            file_name="erd.mmd",
-            mime="text/plain"
-        )
-        # NEW: PDF Download
-        if os.path.exists("output/erd.pdf"):
-            with open("output/erd.pdf", "rb") as f:
-                st.download_button(
-                    "📥 Download ERD PDF",
-                    f.read(),
-                    file_name="erd.pdf",
-                    mime="application/pdf"
-                )
-    
-    # Image Previews (If Rendered)
-    if ag.MERMAID_AVAILABLE:
-        st.markdown("## 🖼️ Rendered Images")
-        col_i1, col_i2, col_i3 = st.columns(3)
-        
-        with col_i1:
-            if os.path.exists("output/dfd.svg"):
-                st.image("output/dfd.svg", caption="DFD", use_column_width=True)
-        
-        with col_i2:
-            if os.path.exists("output/logic.svg"):
-                st.image("output/logic.svg", caption="Logic", use_column_width=True)
-        
-        with col_i3:
-            if os.path.exists("output/erd.svg"):
-                st.image("output/erd.svg", caption="ERD", use_column_width=True)
+    _downloads_and_previews(results["dfd"], results["logic"], results["db"])
 
 else:
     st.info("👆 Upload a file or paste text, then hit Generate!")
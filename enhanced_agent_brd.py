@@ -1,7 +1,17 @@
 import os
 import sys
+import functools
+import hashlib
+import importlib.util
+import io
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
 from dotenv import load_dotenv
 import json  # NEW: For cleaner JSON handling
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # --------- Diagnostics ----------
 def _print_versions():
@@ -13,11 +23,13 @@ def _print_versions():
               f"langchain-openai={getattr(lco, '__version__', 'unknown')}")
     except Exception as e:
         print("[info] version check failed:", e)
-_print_versions()
+if os.environ.get("BRD_VERBOSE"):  # UPDATED: Opt-in, importing langchain-openai just for this is slow
+    _print_versions()
 
 # --------- Imports ----------
-from langchain_openai import ChatOpenAI
+# NEW: langchain_openai / ChatOpenAI and mermaid are imported lazily (see get_llm, _render_svg)
 from langchain_core.prompts import PromptTemplate, ChatPromptTemplate, MessagesPlaceholder
+from langchain_core.runnables import RunnableParallel
 
 # Tool import
 try:
@@ -27,19 +39,60 @@ except Exception:
 
 # NEW: For PDF reading and Mermaid rendering
 try:
-    import pypdf2
-    PDF_AVAILABLE = True
+    import pymupdf  # NEW: MuPDF (C) text extraction, much faster than pure-Python PyPDF2
+    PYMUPDF_AVAILABLE = True
 except ImportError:
-    PDF_AVAILABLE = False
-    print("[warn] Install PyPDF2 for PDF support: pip install pypdf2")
+    PYMUPDF_AVAILABLE = False
 
 try:
-    from mermaid import Mermaid  # From Step 2's mermaid-py
-    MERMAID_AVAILABLE = True
+    import PyPDF2  # Fallback PDF reader
+    PYPDF2_AVAILABLE = True
 except ImportError:
-    MERMAID_AVAILABLE = False
+    PYPDF2_AVAILABLE = False
+
+PDF_AVAILABLE = PYMUPDF_AVAILABLE or PYPDF2_AVAILABLE
+if not PDF_AVAILABLE:
+    print("[warn] Install PyMuPDF for PDF support: pip install pymupdf")
+
+MERMAID_PY_AVAILABLE = importlib.util.find_spec("mermaid") is not None  # From Step 2's mermaid-py
+
+try:
+    from cairosvg import svg2pdf  # NEW: SVG -> PDF export
+    CAIROSVG_AVAILABLE = True
+except (ImportError, OSError):  # OSError: cairosvg installed but libcairo missing
+    CAIROSVG_AVAILABLE = False
+
+from _render_client import start_render_client  # NEW: Optional warm render server
+
+try:
+    import orjson  # NEW: Fast (C) JSON for validating/compacting the ParseBRD output
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+# NEW: Prefer mermaid-cli (mmdc) when installed: npm install -g @mermaid-js/mermaid-cli
+MMDC_PATH = shutil.which("mmdc")
+MERMAID_AVAILABLE = MERMAID_PY_AVAILABLE or MMDC_PATH is not None
+if not MERMAID_AVAILABLE:
     print("[warn] Install mermaid-py for auto-rendering: pip install mermaid-py")
 
+# NEW: Content-addressed SVG cache (on disk + in-process) so identical diagrams skip re-rendering
+_svg_cache_dir = ".mmd_cache"
+_svg_memo = {}
+_svg_memo_lock = threading.Lock()
+
+@functools.lru_cache(maxsize=1)
+def _mermaid_version() -> str:
+    """Renderer name + version, so switching or upgrading renderers invalidates the cache."""
+    try:
+        if MMDC_PATH:
+            out = subprocess.run([MMDC_PATH, "--version"], capture_output=True, text=True, timeout=30)
+            return f"mmdc-{out.stdout.strip()}"
+        from importlib.metadata import version
+        return f"mermaid-py-{version('mermaid-py')}"
+    except Exception:
+        return "unknown"
+
 # --------- API key & Model ----------
 # UPDATED: Lazy load API key for Streamlit Cloud (from st.secrets or .env fallback)
 def get_api_key():
@@ -51,8 +104,30 @@ def get_api_key():
         raise ValueError("❌ OpenAI API key missing! Add to .env (local) or secrets.toml (cloud).")
     return api_key
 
+# NEW: One keep-alive connection pool (HTTP/2 if h2 is installed) shared by every OpenAI call,
+# so the four-call pipeline and the parallel branches skip repeated TCP/TLS handshakes
+@functools.lru_cache(maxsize=1)
+def get_http_clients():
+    import httpx
+    http2 = importlib.util.find_spec("h2") is not None
+    limits = httpx.Limits(max_keepalive_connections=8, max_connections=16)
+    timeout = httpx.Timeout(60.0, connect=10.0)
+    return (httpx.Client(http2=http2, limits=limits, timeout=timeout),
+            httpx.AsyncClient(http2=http2, limits=limits, timeout=timeout))
+
 # Model (now uses lazy key)
-llm = ChatOpenAI(model="gpt-4o-mini", temperature=0.2, api_key=get_api_key())  # Calls on init
+# NEW: Built on first use and cached, so reruns reuse one client (and its HTTP connection pool)
+@functools.lru_cache(maxsize=1)
+def get_llm():
+    from langchain_openai import ChatOpenAI
+    http_client, http_async_client = get_http_clients()
+    return ChatOpenAI(model="gpt-4o-mini", temperature=0.2, api_key=get_api_key(),
+                      http_client=http_client, http_async_client=http_async_client)
+
+# NEW: JSON-mode handle for the prompts that must return JSON (ParseBRD, batched diagrams)
+@functools.lru_cache(maxsize=1)
+def get_llm_json():
+    return get_llm().bind(response_format={"type": "json_object"})
 
 # --------- Prompts & Chains (Unchanged from Your Code) ----------
 parse_prompt = PromptTemplate(
@@ -75,7 +150,6 @@ Respond in JSON only, like:
 }}
 """
 )
-parse_chain = parse_prompt | llm
 
 dfd_prompt = PromptTemplate(
     input_variables=["extracted"],
@@ -88,10 +162,9 @@ flowchart TD
   A[User] --> B[Submit]
   B --> C[System]
 
-Keep it to 5-10 nodes max. Output ONLY the Mermaid code.
+Keep it to 5-10 nodes max. Raw Mermaid only.
 """
 )
-dfd_chain = dfd_prompt | llm
 
 logic_prompt = PromptTemplate(
     input_variables=["extracted"],
@@ -105,10 +178,9 @@ graph TD
   IsExternal -->|Yes| Allocate[Allocate to Admin]
   IsExternal -->|No| Queue[Queue for Triage]
 
-Output ONLY the Mermaid code.
+Raw Mermaid only.
 """
 )
-logic_chain = logic_prompt | llm
 
 db_prompt = PromptTemplate(
     input_variables=["extracted"],
@@ -117,7 +189,7 @@ Create an Entity-Relationship Diagram (ERD) in Mermaid from the entities and rel
 {extracted}
 
 Use: erDiagram; with tables, PK/FK, and relationships like ||--o{{ .
-Output ONLY the Mermaid code, e.g.:
+Raw Mermaid only, e.g.:
 erDiagram
   USER {{
     int id PK
@@ -131,21 +203,97 @@ erDiagram
   USER ||--o{{ ISSUE : "raises"
 """
 )
-db_chain = db_prompt | llm
+# NEW: One batched prompt for all three diagrams (shared header, one round-trip)
+combined_prompt = PromptTemplate(
+    input_variables=["extracted"],
+    template="""
+From this extracted BRD info, create three Mermaid diagrams:
+{extracted}
+
+1. "dfd": a simple Data Flow Diagram using flowchart TD syntax, 5-10 nodes max.
+2. "logic": a decision flowchart (graph TD) built from the RULES, e.g. IsExternal{{External?}} -->|Yes| Allocate.
+3. "erd": an erDiagram with tables, PK/FK, and relationships like ||--o{{ .
+
+Respond in JSON only, each value being the raw Mermaid code as a string:
+{{"dfd": "flowchart TD\\n  ...", "logic": "graph TD\\n  ...", "erd": "erDiagram\\n  ..."}}
+"""
+)
+# Large inputs degrade in batched prompts, so fall back to one prompt per diagram above this size
+COMBINED_PROMPT_MAX_CHARS = 6000
+
+# NEW: Chains are composed on first use, so importing this module needs no API key
+@functools.lru_cache(maxsize=1)
+def get_chains() -> dict:
+    llm = get_llm()
+    chains = {
+        "parse": parse_prompt | get_llm_json(),
+        "dfd": dfd_prompt | llm,
+        "logic": logic_prompt | llm,
+        "db": db_prompt | llm,
+        "combined": combined_prompt | get_llm_json(),
+    }
+    # The three diagram chains only depend on the extracted JSON, so fan them out concurrently
+    chains["diagrams"] = RunnableParallel(dfd=chains["dfd"], logic=chains["logic"], db=chains["db"])
+    return chains
 
 # --------- Tool functions (Unchanged) ----------
+_FENCE_RE = re.compile(r"^\s*```(?:mermaid)?|```\s*$", re.M)
+
+def strip_mermaid_fences(code: str) -> str:
+    """NEW: Drop the ```mermaid fences the model sometimes adds anyway."""
+    return _FENCE_RE.sub("", code).strip()
+
+def _compact_json(text: str) -> str:
+    """NEW: Minify JSON so {extracted} costs fewer tokens in every diagram prompt. Non-JSON passes through."""
+    try:
+        if ORJSON_AVAILABLE:
+            return orjson.dumps(orjson.loads(text)).decode("utf-8")
+        return json.dumps(json.loads(text), separators=(",", ":"), ensure_ascii=False)
+    except ValueError:  # orjson.JSONDecodeError is a ValueError too
+        return text
+
 def parse_brd_tool(input_text: str) -> str:
-    msg = parse_chain.invoke({"brd_text": input_text})
-    return getattr(msg, "content", str(msg))
+    msg = get_chains()["parse"].invoke({"brd_text": input_text})
+    return _compact_json(getattr(msg, "content", str(msg)))
 
 def generate_dfd_tool(extracted_json: str) -> str:
-    return dfd_chain.invoke({"extracted": extracted_json}).content
+    return strip_mermaid_fences(get_chains()["dfd"].invoke({"extracted": extracted_json}).content)
 
 def generate_logic_tool(extracted_json: str) -> str:
-    return logic_chain.invoke({"extracted": extracted_json}).content
+    return strip_mermaid_fences(get_chains()["logic"].invoke({"extracted": extracted_json}).content)
 
 def generate_db_tool(extracted_json: str) -> str:
-    return db_chain.invoke({"extracted": extracted_json}).content
+    return strip_mermaid_fences(get_chains()["db"].invoke({"extracted": extracted_json}).content)
+
+# NEW: Streaming variants yield Mermaid code chunk by chunk (for live UI output)
+def _stream_content(chain, extracted_json: str):
+    for chunk in chain.stream({"extracted": extracted_json}):
+        yield chunk.content
+
+def stream_dfd_tool(extracted_json: str):
+    return _stream_content(get_chains()["dfd"], extracted_json)
+
+def stream_logic_tool(extracted_json: str):
+    return _stream_content(get_chains()["logic"], extracted_json)
+
+def stream_db_tool(extracted_json: str):
+    return _stream_content(get_chains()["db"], extracted_json)
+
+def _generate_diagrams_separately(extracted_json: str) -> tuple:
+    result = get_chains()["diagrams"].invoke({"extracted": extracted_json}, config={"max_concurrency": 3})
+    return tuple(strip_mermaid_fences(result[k].content) for k in ("dfd", "logic", "db"))
+
+def generate_all_diagrams_tool(extracted_json: str) -> tuple:
+    """NEW: Generate DFD, Logic and ERD codes in one batched call. Returns (dfd, logic, db)."""
+    if len(extracted_json) > COMBINED_PROMPT_MAX_CHARS:
+        return _generate_diagrams_separately(extracted_json)
+    content = get_chains()["combined"].invoke({"extracted": extracted_json}).content
+    try:
+        data = json.loads(content)
+        return tuple(strip_mermaid_fences(data[k]) for k in ("dfd", "logic", "erd"))
+    except (ValueError, KeyError, TypeError) as e:
+        print(f"[warn] Batched diagram output unusable ({e}). Generating one by one…")
+        return _generate_diagrams_separately(extracted_json)
 
 tools = [
     Tool(name="ParseBRD", description="Extract processes, flows, rules, entities from BRD text. Input: BRD text string.", func=parse_brd_tool),
@@ -191,9 +339,33 @@ You are an expert BRD Diagram Agent. Take a BRD (text/file), parse it, and gener
     except Exception:
         return None
 
-agent = build_agent(llm, tools)
+# UPDATED: Built on first use instead of at import
+@functools.lru_cache(maxsize=1)
+def get_agent():
+    return build_agent(get_llm(), tools)
+
+# NEW: The tools always run in the same order (ParseBRD -> Gen*), so the ReAct loop only
+# adds tool-selection round-trips; keep it for long BRDs, use the direct pipeline otherwise
+AGENT_THRESHOLD = int(os.getenv("BRD_AGENT_THRESHOLD", "8000"))  # chars
+
+def agent_for(brd_text: str):
+    """Return the agent if this BRD is long enough to warrant it, else None (use the pipeline)."""
+    if len(brd_text) <= AGENT_THRESHOLD:
+        return None
+    return get_agent()
 
 # --------- Enhanced Helpers ----------
+def extract_pdf_text(data: bytes) -> str:
+    """NEW: Extract text from PDF bytes with PyMuPDF (falls back to PyPDF2)."""
+    if PYMUPDF_AVAILABLE:
+        with pymupdf.open(stream=data, filetype="pdf") as doc:
+            return "\n".join(page.get_text() for page in doc)
+    reader = PyPDF2.PdfReader(io.BytesIO(data))
+    parts = []
+    for page in reader.pages:
+        parts.append(page.extract_text() or "")  # Collect + join once (+= is quadratic)
+    return "\n".join(parts)
+
 def read_file_if_needed(user_input: str) -> str:
     """NEW: Now handles PDFs too!"""
     if user_input.endswith(('.txt', '.md')) and os.path.exists(user_input):
@@ -202,33 +374,124 @@ def read_file_if_needed(user_input: str) -> str:
     elif PDF_AVAILABLE and user_input.endswith('.pdf') and os.path.exists(user_input):
         try:
             with open(user_input, 'rb') as f:
-                reader = pypdf2.PdfReader(f)
-                text = ""
-                for page in reader.pages:
-                    text += page.extract_text() + "\n"
-                return text.strip()
+                return extract_pdf_text(f.read()).strip()
         except Exception as e:
             print(f"[warn] PDF read failed: {e}. Treating as text.")
             return user_input
     return user_input
 
-def render_and_save_mermaid(mermaid_code: str, diagram_type: str, output_dir: str = "output"):
-    """NEW: Render Mermaid code to SVG/PNG and save."""
-    if not MERMAID_AVAILABLE:
-        return mermaid_code  # Fallback to text
+def _write_svg_cache(cache_path: str, svg: bytes):
+    """Write atomically so concurrent renders never see a half-written cache entry."""
+    try:
+        os.makedirs(_svg_cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=_svg_cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(svg)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print(f"[warn] SVG cache write failed: {e}")
+
+def _renderer_id(render_client=None) -> str:
+    return f"server-{render_client.url}" if render_client is not None else _mermaid_version()
+
+def _render_svg(mermaid_code: str, file_path: str, render_client=None) -> str:
+    """Render to file_path; returns the id of the renderer that actually produced the SVG."""
+    if render_client is not None:
+        try:  # No liveness probe here: a dead server just fails this POST and we render locally
+            svg = render_client.render_svg(mermaid_code)
+            with open(file_path, "wb") as f:
+                f.write(svg)
+            return _renderer_id(render_client)
+        except Exception as e:
+            print(f"[warn] Render server failed: {e}. Rendering locally.")
+    if MMDC_PATH:
+        # mermaid-cli reads the diagram from stdin, no temp .mmd file needed
+        subprocess.run([MMDC_PATH, "-i", "-", "-o", file_path], input=mermaid_code.encode("utf-8"),
+                       capture_output=True, check=True, timeout=120)
+    else:
+        from mermaid import Mermaid
+        Mermaid(mermaid_code).svg(outputfile=file_path)
+    return _renderer_id()
 
+def render_mermaid_file(mermaid_code: str, diagram_type: str, output_dir: str = "output", render_client=None):
+    """NEW: Render to <output_dir>/<type>.svg. Returns the SVG path, or None if nothing was written."""
+    if not MERMAID_AVAILABLE and render_client is None:
+        return None
+
+    mermaid_code = strip_mermaid_fences(mermaid_code)  # Safety net if a caller passes fenced code
     os.makedirs(output_dir, exist_ok=True)
     file_name = f"{diagram_type.lower()}.svg"
     file_path = os.path.join(output_dir, file_name)
 
+    renderer = _renderer_id(render_client)
+    key = hashlib.sha256((mermaid_code + renderer).encode("utf-8")).hexdigest()
+    cache_path = os.path.join(_svg_cache_dir, f"{key}.svg")
+
+    with _svg_memo_lock:
+        svg = _svg_memo.get(key)
+    if svg is None and os.path.exists(cache_path):
+        with open(cache_path, "rb") as f:
+            svg = f.read()
+        with _svg_memo_lock:
+            _svg_memo[key] = svg
+    if svg is not None:
+        with open(file_path, "wb") as f:
+            f.write(svg)
+        print(f"💾 Saved {diagram_type} image (cached): {file_path}")
+        return file_path
+
     try:
-        diagram = Mermaid(mermaid_code)
-        diagram.svg(outputfile=file_path)
+        used = _render_svg(mermaid_code, file_path, render_client)
+        if used == renderer:  # A local fallback render must not be cached under the server's key
+            with open(file_path, "rb") as f:
+                svg = f.read()
+            with _svg_memo_lock:
+                _svg_memo[key] = svg
+            _write_svg_cache(cache_path, svg)
         print(f"💾 Saved {diagram_type} image: {file_path}")
-        return f"Rendered image saved: {file_path}\nCode: {mermaid_code}"
+        return file_path
     except Exception as e:
         print(f"[warn] Rendering failed: {e}")
-        return mermaid_code
+        return None
+
+def render_and_save_mermaid(mermaid_code: str, diagram_type: str, output_dir: str = "output", render_client=None):
+    """NEW: Render Mermaid code to SVG/PNG and save."""
+    file_path = render_mermaid_file(mermaid_code, diagram_type, output_dir, render_client)
+    if file_path is None:
+        return mermaid_code  # Fallback to text
+    return f"Rendered image saved: {file_path}\nCode: {mermaid_code}"
+
+def render_batch_mermaid(codes_by_type: dict, output_dir: str = "output", render_client=None,
+                         on_rendered=None) -> dict:
+    """NEW: Render several diagrams concurrently, e.g. {"DFD": dfd, "ERD": db}. Returns {type: result}.
+
+    on_rendered(diagram_type, svg_path) is called as each diagram is successfully written,
+    e.g. to start PDF export early. Failed renders never trigger it.
+    """
+    if not MERMAID_AVAILABLE and render_client is None:
+        return dict(codes_by_type)
+    results = {}
+    with ThreadPoolExecutor(max_workers=max(len(codes_by_type), 1)) as pool:
+        futures = {pool.submit(render_mermaid_file, code, t, output_dir, render_client): t
+                   for t, code in codes_by_type.items()}
+        for future in as_completed(futures):
+            diagram_type = futures[future]
+            svg_path = future.result()
+            code = codes_by_type[diagram_type]
+            if svg_path is None:
+                results[diagram_type] = code
+                continue
+            results[diagram_type] = f"Rendered image saved: {svg_path}\nCode: {code}"
+            if on_rendered is not None:
+                on_rendered(diagram_type, svg_path)
+    return results
+
+def svg_to_pdf(svg_path: str, pdf_path: str) -> bytes:
+    """NEW: Convert a rendered SVG to PDF, save it and return the bytes. Top-level so it can run in a process pool."""
+    pdf_bytes = svg2pdf(url=svg_path)
+    with open(pdf_path, "wb") as f:
+        f.write(pdf_bytes)
+    return pdf_bytes
 
 # --------- Run (Enhanced Output) ----------
 if __name__ == "__main__":
@@ -243,23 +506,21 @@ if __name__ == "__main__":
         sys.exit(0)
 
     print("🤖 Agent starting...")
+    agent = agent_for(brd_text)
     if agent is not None:
         result = agent.invoke({"input": brd_text})
         output = result if isinstance(result, str) else result.get("output", str(result))
     else:
         # Fallback: Direct pipeline + NEW rendering/saving
-        print("[info] Agent API not available. Running direct pipeline…")
+        print("[info] Running direct pipeline…")
         extracted = parse_brd_tool(brd_text)
         print("\n[Extracted JSON]\n", extracted)
         
-        dfd = generate_dfd_tool(extracted)
-        print("\n[DFD]\n", render_and_save_mermaid(dfd, "DFD"))
-        
-        logic = generate_logic_tool(extracted)
-        print("\n[Logic]\n", render_and_save_mermaid(logic, "Logic"))
-        
-        db = generate_db_tool(extracted)
-        print("\n[ERD]\n", render_and_save_mermaid(db, "ERD"))
+        dfd, logic, db = generate_all_diagrams_tool(extracted)
+        rendered = render_batch_mermaid({"DFD": dfd, "Logic": logic, "ERD": db}, render_client=start_render_client())
+        print("\n[DFD]\n", rendered["DFD"])
+        print("\n[Logic]\n", rendered["Logic"])
+        print("\n[ERD]\n", rendered["ERD"])
         
         output = "Pipeline complete with renders!"
 